@@ -3,107 +3,94 @@
 Relative Winrate pro Runde mit Wilson-Intervallen (Bias-Reducer)
 Denominator: alle Matches, die Runde r erreichen
 Numerator WITH:  gewonnene Matches MIT Item X in r
-Numerator WITHOUT: gewonnene Matches OHNE Item X in r  (explizit exkludiert)
+Numerator WITHOUT: gewonnene Matches OHNE Item X in r  (= alle Wins in r − Wins MIT X)
 Metrik: ΔWinrate = Winrate_mit − Winrate_ohne
 Outputs: CSV + Parquet
 """
 import os
 import duckdb
+import numpy as np
+import pyarrow as pa
+
+from bpb_common import ensure_denom, ensure_item_dict, prewarm
 
 Z = 1.96  # ~95% Wilson
 
-SQL = f"""
+SQL = """
+-- denom(round, n_reached) kommt als Temp-Tabelle aus bpb_common.ensure_denom
 WITH
--- Wie viele Matches haben Runde r erreicht?
-denom AS (
-  SELECT
-    r.round_index AS round,
-    COUNT(DISTINCT r.match_id) AS n_reached
-  FROM battles.rounds r
-  GROUP BY r.round_index
-),
-
--- Alle (round, item) Paare, die in Runde r überhaupt vorkamen
+-- Alle (round, item_id) Paare, die in Runde r überhaupt vorkamen
 items_in_round AS (
   SELECT DISTINCT
     ri.round_index AS round,
-    ri.item_name
-  FROM battles.round_items ri
+    ri.item_id
+  FROM ri_int ri
 ),
 
 -- Alle Matches, die in Runde r ein bestimmtes Item tragen
 matches_with AS (
   SELECT DISTINCT
     ri.round_index AS round,
-    ri.item_name,
+    ri.item_id,
     ri.match_id
-  FROM battles.round_items ri
+  FROM ri_int ri
 ),
 
 -- Wins MIT Item X in Runde r
 wins_with AS (
   SELECT
     mw.round,
-    mw.item_name,
-    COUNT(DISTINCT r.match_id) AS wins_with
+    mw.item_id,
+    COUNT(*) AS wins_with
   FROM matches_with mw
-  JOIN battles.rounds r
-    ON r.match_id = mw.match_id AND r.round_index = mw.round
-  WHERE r.result = 'win'
+  JOIN wins_rr w
+    ON w.match_id = mw.match_id AND w.round_index = mw.round
   GROUP BY 1,2
 ),
 
--- Wins OHNE Item X in Runde r: zähle nur gewonnene Matches,
--- die Runde r erreicht haben UND das Item dort NICHT tragen
-wins_without AS (
+-- Alle gewonnenen Matches, die Runde r erreicht haben (|rounds| Zeilen).
+-- Wins OHNE Item X = wins_total − wins_with; spart den Anti-Join über alle (Win, Item)-Kombinationen.
+wins_total AS (
   SELECT
-    iir.round AS round,
-    iir.item_name,
-    COUNT(DISTINCT r.match_id) AS wins_without
-  FROM items_in_round iir
-  JOIN battles.rounds r
-    ON r.round_index = iir.round
-  LEFT JOIN matches_with mw
-    ON mw.match_id = r.match_id
-   AND mw.round     = iir.round
-   AND mw.item_name = iir.item_name
-  WHERE r.result = 'win'
-    AND mw.match_id IS NULL
-  GROUP BY 1,2
+    w.round_index AS round,
+    COUNT(*) AS wins_total
+  FROM wins_rr w
+  GROUP BY 1
 ),
 
 -- Für Usage-Rate: wie viele Matches in r tragen Item X (unabhängig vom Ergebnis)
 usage AS (
   SELECT
     iir.round,
-    iir.item_name,
-    COUNT(DISTINCT mw.match_id) AS usage_matches
+    iir.item_id,
+    COUNT(mw.match_id) AS usage_matches
   FROM items_in_round iir
   LEFT JOIN matches_with mw
-    ON mw.round = iir.round AND mw.item_name = iir.item_name
+    ON mw.round = iir.round AND mw.item_id = iir.item_id
   GROUP BY 1,2
 ),
 
 stats AS (
   SELECT
     iir.round,
-    iir.item_name,
+    dn.item_name,
     d.n_reached,
     COALESCE(u.usage_matches, 0) AS usage_matches,
-    COALESCE(ww.wins_with,   0)  AS wins_with,
-    COALESCE(wo.wins_without,0)  AS wins_without,
+    COALESCE(ww.wins_with, 0)                               AS wins_with,
+    COALESCE(wt.wins_total, 0) - COALESCE(ww.wins_with, 0)  AS wins_without,
 
     -- Winrates gegen denselben Denominator n_reached (Bias-Reducer)
-    (COALESCE(ww.wins_with,   0) * 1.0) / NULLIF(d.n_reached, 0) AS winrate_with,
-    (COALESCE(wo.wins_without,0) * 1.0) / NULLIF(d.n_reached, 0) AS winrate_without
+    (COALESCE(ww.wins_with, 0) * 1.0) / NULLIF(d.n_reached, 0)                              AS winrate_with,
+    ((COALESCE(wt.wins_total, 0) - COALESCE(ww.wins_with, 0)) * 1.0) / NULLIF(d.n_reached, 0) AS winrate_without
   FROM items_in_round iir
+  JOIN item_dict dn       ON dn.item_id = iir.item_id
   LEFT JOIN denom d       ON d.round = iir.round
-  LEFT JOIN wins_with ww  ON ww.round = iir.round AND ww.item_name = iir.item_name
-  LEFT JOIN wins_without wo ON wo.round = iir.round AND wo.item_name = iir.item_name
-  LEFT JOIN usage u       ON u.round = iir.round AND u.item_name = iir.item_name
+  LEFT JOIN wins_with ww  ON ww.round = iir.round AND ww.item_id = iir.item_id
+  LEFT JOIN wins_total wt ON wt.round = iir.round
+  LEFT JOIN usage u       ON u.round = iir.round AND u.item_id = iir.item_id
 ),
 
-wilson AS (
+metrics AS (
   SELECT
     round,
     item_name,
@@ -116,73 +103,76 @@ wilson AS (
 
     winrate_with,
     winrate_without,
-    (winrate_with - winrate_without) AS delta_winrate,
-
-    -- Wilson-Intervalle für WITH
-    CASE
-      WHEN n_reached > 0 THEN
-        ((wins_with + {Z}*{Z}/2.0) / (n_reached + {Z}*{Z}))
-        - ({Z} * sqrt( (wins_with*(n_reached - wins_with)/NULLIF(n_reached,0) + {Z}*{Z}/4.0)
-                        / pow(n_reached + {Z}*{Z}, 2) ))
-      ELSE NULL
-    END AS wilson_with_lo,
-    CASE
-      WHEN n_reached > 0 THEN
-        ((wins_with + {Z}*{Z}/2.0) / (n_reached + {Z}*{Z}))
-        + ({Z} * sqrt( (wins_with*(n_reached - wins_with)/NULLIF(n_reached,0) + {Z}*{Z}/4.0)
-                        / pow(n_reached + {Z}*{Z}, 2) ))
-      ELSE NULL
-    END AS wilson_with_hi,
-
-    -- Wilson-Intervalle für WITHOUT
-    CASE
-      WHEN n_reached > 0 THEN
-        ((wins_without + {Z}*{Z}/2.0) / (n_reached + {Z}*{Z}))
-        - ({Z} * sqrt( (wins_without*(n_reached - wins_without)/NULLIF(n_reached,0) + {Z}*{Z}/4.0)
-                        / pow(n_reached + {Z}*{Z}, 2) ))
-      ELSE NULL
-    END AS wilson_without_lo,
-    CASE
-      WHEN n_reached > 0 THEN
-        ((wins_without + {Z}*{Z}/2.0) / (n_reached + {Z}*{Z}))
-        + ({Z} * sqrt( (wins_without*(n_reached - wins_without)/NULLIF(n_reached,0) + {Z}*{Z}/4.0)
-                        / pow(n_reached + {Z}*{Z}, 2) ))
-      ELSE NULL
-    END AS wilson_without_hi
+    (winrate_with - winrate_without) AS delta_winrate
   FROM stats
 )
 
 SELECT *
-FROM wilson
+FROM metrics
 WHERE n_reached >= ?
+{qualify}
 ORDER BY round, delta_winrate DESC, n_reached DESC, item_name;
 """
 
-def main():
+def wilson_bounds(wins, n, z=Z):
+    """Wilson-Intervall (lo, hi) vektorisiert über ganze Spalten; n == 0 -> NaN."""
+    x = np.asarray(wins, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    z2 = z * z
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denom = n + z2
+        center = (x + z2 / 2.0) / denom
+        half = z * np.sqrt((x * (n - x) / n + z2 / 4.0) / denom**2)
+    valid = n > 0
+    return np.where(valid, center - half, np.nan), np.where(valid, center + half, np.nan)
+
+
+def main(min_round_reached=25, topk=None):
+    """topk: nur die besten topk Items je Runde (nach ΔWinrate) ausgeben; None = alle (04 braucht die vollen Kurven)."""
     outdir = "bpb_out"
-    min_round_reached = 25  # wie gehabt
 
     os.makedirs(outdir, exist_ok=True)
 
     con = duckdb.connect("bpb_out/bpb.duckdb")
     con.execute("SET schema='battles';")
+    prewarm(con)
+
+    ensure_denom(con)
+
+    # Item-Namen -> Integer-IDs (item_dict, ri_int); die Query gruppiert/joint nur auf item_id
+    # und holt den Namen erst für die Ausgabe zurück.
+    ensure_item_dict(con)
+    # Gewonnene (match, round)-Paare einmal vorfiltern statt rounds mehrfach zu scannen.
+    con.execute("""
+        CREATE TEMP TABLE wins_rr AS
+        SELECT match_id, round_index
+        FROM battles.rounds
+        WHERE result = 'win';
+    """)
+
+    # Top-K je Runde direkt in DuckDB (QUALIFY, partielle Sortierung pro Partition)
+    qualify = ""
+    if topk is not None:
+        qualify = (
+            "QUALIFY row_number() OVER (PARTITION BY round ORDER BY delta_winrate DESC, n_reached DESC, item_name)"
+            f" <= {int(topk)}"
+        )
+    tbl = con.execute(SQL.format(qualify=qualify), [min_round_reached]).fetch_arrow_table()
 
-    df = con.execute(SQL, [min_round_reached]).df()
+    # Wilson-Intervalle spaltenweise in NumPy statt als CASE-Ausdrücke pro Zeile in SQL
+    n_reached = tbl.column("n_reached").to_numpy()
+    lo, hi = wilson_bounds(tbl.column("wins_with").to_numpy(), n_reached)
+    tbl = tbl.append_column("wilson_with_lo", pa.array(lo)).append_column("wilson_with_hi", pa.array(hi))
+    lo, hi = wilson_bounds(tbl.column("wins_without").to_numpy(), n_reached)
+    tbl = tbl.append_column("wilson_without_lo", pa.array(lo)).append_column("wilson_without_hi", pa.array(hi))
 
     csv_path = os.path.join(outdir, "relative_winrate_by_round.csv")
     parquet_path = os.path.join(outdir, "relative_winrate_by_round.parquet")
-    df.to_csv(csv_path, index=False)
-
-    try:
-        con.execute(
-            "COPY (SELECT * FROM read_csv_auto(?)) TO ? (FORMAT PARQUET);",
-            [csv_path, parquet_path]
-        )
-    except Exception:
-        # Parquet optional. DuckDB hat eh den CSV.
-        pass
+    con.register("relative_winrate", tbl)
+    con.execute(f"COPY relative_winrate TO '{csv_path}' (FORMAT CSV, HEADER)")
+    con.execute(f"COPY relative_winrate TO '{parquet_path}' (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)")
 
-    print(f"rows={len(df):,}")
+    print(f"rows={tbl.num_rows:,}")
     print("wrote:", csv_path)
     print("wrote:", parquet_path)
 
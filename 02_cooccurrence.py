@@ -6,130 +6,107 @@ Outputs: CSV + Parquet nach bpb_out/
 import os
 import duckdb
 
+from bpb_common import ensure_finals, ensure_item_dict, prewarm
+
 # ============== CONFIG =================
 DB_PATH        = os.environ.get("BPB_DB", "bpb_out/bpb.duckdb")
 OUT_DIR        = "bpb_out"
 SCOPE          = "final"   # "final" oder "topn"
 TOPN           = 3         # gilt nur bei SCOPE="topn"
 MIN_PAIR_COUNT = 20
+TOPK           = None      # nur die TOPK Paare nach PMI ausgeben; None = alle (05 nutzt die volle Liste)
 # =======================================
 
 os.makedirs(OUT_DIR, exist_ok=True)
 con = duckdb.connect(DB_PATH)
 con.execute("SET schema='battles';")
+prewarm(con)
+ensure_finals(con)
 
-SQL_FINAL_SCOPE = """
-WITH last_round AS (
-  SELECT match_id, MAX(round_index) AS last_r
-  FROM battles.rounds
-  GROUP BY match_id
-),
-scope as (
-  SELECT ri.match_id, ri.item_name
-  FROM battles.round_items ri
-  JOIN last_round lr USING (match_id)
-  WHERE ri.round_index = lr.last_r
+# Item-Namen einmal auf Integer-IDs abbilden (item_dict, ri_int); Gruppierung/Joins laufen auf item_id.
+ensure_item_dict(con)
+
+# Eine Query für beide Scopes: $1 = Anzahl letzter Runden (1 = nur finale Runde), $2 = MIN_PAIR_COUNT
+SQL_COOCC = """
+WITH scope AS (
+  SELECT DISTINCT ri.match_id, ri.item_id
+  FROM finals f
+  JOIN ri_int ri ON ri.match_id = f.match_id
+  WHERE ri.round_index >= (f.last_r - $1 + 1) AND ri.round_index <= f.last_r
 ),
 universe AS (
   SELECT COUNT(DISTINCT match_id) AS M FROM scope
 ),
 pA AS (
-  SELECT item_name AS A, COUNT(DISTINCT match_id) AS nA FROM scope GROUP BY item_name
+  SELECT item_id AS A, COUNT(*) AS nA FROM scope GROUP BY item_id
 ),
 pB AS (
-  SELECT item_name AS B, COUNT(DISTINCT match_id) AS nB FROM scope GROUP BY item_name
-),
-pairs AS (
-  SELECT
-    s1.item_name AS A,
-    s2.item_name AS B,
-    COUNT(DISTINCT s1.match_id) AS nAB
-  FROM scope s1
-  JOIN scope s2
-    ON s1.match_id = s2.match_id
-   AND s1.item_name < s2.item_name
-  GROUP BY 1,2
-)
-SELECT
-  pr.A, pr.B, pr.nAB,
-  pa.nA, pb.nB, u.M,
-  (pr.nAB * 1.0) / u.M AS pAB,
-  (pa.nA  * 1.0) / u.M AS pA,
-  (pb.nB  * 1.0) / u.M AS pB,
-  CASE WHEN pa.nA>0 AND pb.nB>0 AND pr.nAB>0 THEN ( (pr.nAB * 1.0) / u.M ) / ( (pa.nA*1.0)/u.M * (pb.nB*1.0)/u.M ) END AS lift,
-  CASE WHEN pa.nA>0 AND pb.nB>0 AND pr.nAB>0 THEN log2( ( (pr.nAB * 1.0) / u.M ) / ( (pa.nA*1.0)/u.M * (pb.nB*1.0)/u.M ) ) END AS pmi
-FROM pairs pr
-JOIN pA pa ON pa.A = pr.A
-JOIN pB pb ON pb.B = pr.B
-CROSS JOIN universe u
-WHERE pr.nAB >= ?
-ORDER BY pmi DESC, lift DESC, nAB DESC;
-"""
-
-SQL_TOPN_SCOPE = """
-WITH last_round AS (
-  SELECT match_id, MAX(round_index) AS last_r
-  FROM battles.rounds
-  GROUP BY match_id
+  SELECT item_id AS B, COUNT(*) AS nB FROM scope GROUP BY item_id
 ),
-scope AS (
-  SELECT ri.match_id, ri.item_name
-  FROM battles.round_items ri
-  JOIN last_round lr USING (match_id)
-  WHERE ri.round_index >= (lr.last_r - ? + 1) AND ri.round_index <= lr.last_r
+-- Paare ohne Self-Join: je Match die sortierte Item-Liste, dann pro Position i
+-- nur die Items dahinter entfalten -> genau k(k-1)/2 Zeilen pro Match.
+match_items AS (
+  SELECT match_id, list_sort(list(item_id)) AS items FROM scope GROUP BY match_id
 ),
-universe AS (
-  SELECT COUNT(DISTINCT match_id) AS M FROM scope
-),
-pA AS (
-  SELECT item_name AS A, COUNT(DISTINCT match_id) AS nA FROM scope GROUP BY item_name
-),
-pB AS (
-  SELECT item_name AS B, COUNT(DISTINCT match_id) AS nB FROM scope GROUP BY item_name
+match_pos AS (
+  SELECT items, unnest(generate_series(1, len(items))) AS i FROM match_items
 ),
 pairs AS (
-  SELECT
-    s1.item_name AS A,
-    s2.item_name AS B,
-    COUNT(DISTINCT s1.match_id) AS nAB
-  FROM scope s1
-  JOIN scope s2
-    ON s1.match_id = s2.match_id
-   AND s1.item_name < s2.item_name
+  SELECT A, B, COUNT(*) AS nAB
+  FROM (
+    SELECT items[i] AS A, unnest(list_slice(items, i + 1, len(items))) AS B
+    FROM match_pos
+  )
   GROUP BY 1,2
 )
+-- Jede Quote genau einmal berechnen; lift/pmi bauen auf pAB/pA/pB auf (pmi per Alias auf lift)
 SELECT
-  pr.A, pr.B, pr.nAB,
-  pa.nA, pb.nB, u.M,
-  (pr.nAB * 1.0) / u.M AS pAB,
-  (pa.nA  * 1.0) / u.M AS pA,
-  (pb.nB  * 1.0) / u.M AS pB,
-  CASE WHEN pa.nA>0 AND pb.nB>0 AND pr.nAB>0 THEN ( (pr.nAB * 1.0) / u.M ) / ( (pa.nA*1.0)/u.M * (pb.nB*1.0)/u.M ) END AS lift,
-  CASE WHEN pa.nA>0 AND pb.nB>0 AND pr.nAB>0 THEN log2( ( (pr.nAB * 1.0) / u.M ) / ( (pa.nA*1.0)/u.M * (pb.nB*1.0)/u.M ) ) END AS pmi
-FROM pairs pr
-JOIN pA pa ON pa.A = pr.A
-JOIN pB pb ON pb.B = pr.B
-CROSS JOIN universe u
-WHERE pr.nAB >= ?
-ORDER BY pmi DESC, lift DESC, nAB DESC;
+  A, B, nAB, nA, nB, M, pAB, pA, pB,
+  CASE WHEN nA>0 AND nB>0 AND nAB>0 THEN pAB / (pA * pB) END AS lift,
+  log2(lift) AS pmi
+FROM (
+  SELECT
+    da.item_name AS A, db.item_name AS B, pr.nAB,
+    pa.nA, pb.nB, u.M,
+    (pr.nAB * 1.0) / u.M AS pAB,
+    (pa.nA  * 1.0) / u.M AS pA,
+    (pb.nB  * 1.0) / u.M AS pB
+  FROM pairs pr
+  JOIN pA pa ON pa.A = pr.A
+  JOIN pB pb ON pb.B = pr.B
+  JOIN item_dict da ON da.item_id = pr.A
+  JOIN item_dict db ON db.item_id = pr.B
+  CROSS JOIN universe u
+  WHERE pr.nAB >= $2
+)
+{qualify}
+ORDER BY pmi DESC, lift DESC, nAB DESC
 """
 
 if SCOPE == "final":
-    df = con.execute(SQL_FINAL_SCOPE, [MIN_PAIR_COUNT]).df()
-    tag = "final"
+    window, tag = 1, "final"
 else:
-    df = con.execute(SQL_TOPN_SCOPE, [TOPN, MIN_PAIR_COUNT]).df()
-    tag = f"top{TOPN}"
+    window, tag = TOPN, f"top{TOPN}"
 
 csv_path = os.path.join(OUT_DIR, f"cooccurrence_{tag}.csv")
 parquet_path = os.path.join(OUT_DIR, f"cooccurrence_{tag}.parquet")
-df.to_csv(csv_path, index=False)
 
-try:
-    con.execute("COPY (SELECT * FROM read_csv_auto(?)) TO ? (FORMAT PARQUET);", [csv_path, parquet_path])
-except Exception:
-    pass
+# Optional Top-K direkt in DuckDB abschneiden statt alles zu sortieren und zu schreiben
+qualify = ""
+if TOPK is not None:
+    qualify = f"QUALIFY row_number() OVER (ORDER BY pmi DESC, lift DESC, nAB DESC) <= {int(TOPK)}"
+
+# Eine Query für beide Scopes: SELECT vorbereiten, Scope-Parameter beim EXECUTE einsetzen
+# (EXECUTE nimmt keine Client-Parameter, daher die beiden Integer inline)
+con.execute(f"PREPARE coocc AS {SQL_COOCC.format(qualify=qualify)}")
+tbl = con.execute(f"EXECUTE coocc({int(window)}, {int(MIN_PAIR_COUNT)})").fetch_arrow_table()
+
+# Arrow-Ergebnis registrieren und von DuckDB direkt nach CSV + Parquet schreiben
+con.register("cooccurrence", tbl)
+con.execute(f"COPY cooccurrence TO '{csv_path}' (FORMAT CSV, HEADER)")
+con.execute(f"COPY cooccurrence TO '{parquet_path}' (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)")
+n_rows = tbl.num_rows
 
-print(f"rows={len(df):,}")
+print(f"rows={n_rows:,}")
 print("wrote:", csv_path)
 print("wrote:", parquet_path)
@@ -8,12 +8,19 @@ Outputs: bpb_out/reaper_clusters_*.csv
   - reaper_clusters_core_items.csv (Lift- & Frequenz-Listen)
   - reaper_clusters_item_stats.csv (Detailmetriken je Item x Cluster)
 """
+import json
 import os
 import duckdb
-import re
 import pandas as pd
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.feature_extraction.text import TfidfTransformer
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import scipy.sparse as sp
+
+from bpb_common import ensure_finals, prewarm
 
 # ============== CONFIG =================
 DB_PATH        = os.environ.get("BPB_DB", "bpb_out/bpb.duckdb")
@@ -21,6 +28,11 @@ OUT_DIR        = "bpb_out"
 K              = 8
 MIN_ITEM_FREQ  = 15
 MAX_ITEMS      = 300
+# MiniBatchKMeans
+KMEANS_N_INIT      = 3
+KMEANS_BATCH_SIZE  = 4096
+KMEANS_MAX_ITER    = 200
+TFIDF_WEIGHTING    = False  # True: Spalten per TF-IDF gewichten, damit Staples die Distanzen nicht dominieren
 # Core-Item-Heuristik (Items, die wirklich cluster-typisch sind)
 CORE_TOP_K             = 8
 CORE_MIN_CLUSTER_RATE  = 0.30   # Anteil der Matches im Cluster, die das Item haben
@@ -34,143 +46,185 @@ CLASS_REGEX    = None  # z.B. r"reaper"  -> filtert nur Matches, die irgendwo ei
 os.makedirs(OUT_DIR, exist_ok=True)
 con = duckdb.connect(DB_PATH)
 con.execute("SET schema='battles';")
+prewarm(con)
 
 def fetch_final_items(con, class_regex):
-    # letzte Runde je Match inkl. Ergebnis
-    last_round_df = con.execute("""
-        WITH last_round AS (
-          SELECT match_id, MAX(round_index) AS last_r
-          FROM battles.rounds
-          GROUP BY match_id
-        )
-        SELECT lr.match_id, lr.last_r, r.result
-        FROM last_round lr
-        JOIN battles.rounds r
-          ON r.match_id = lr.match_id AND r.round_index = lr.last_r
-    """).df()
-
-    # Items in der finalen Runde
-    items_df = con.execute("""
-        WITH last_round AS (
-          SELECT match_id, MAX(round_index) AS last_r
-          FROM battles.rounds
-          GROUP BY match_id
-        )
-        SELECT ri.match_id, ri.item_name
-        FROM battles.round_items ri
-        JOIN last_round lr USING (match_id)
-        WHERE ri.round_index = lr.last_r
-    """).df()
-
-    # Optionaler Klassenfilter: irgendein Item des Matches matcht regex
+    """Materialisiert final_items(match_id, item_name, result, last_r) als Temp-Tabelle; gibt Zeilenzahl zurück."""
+    # Optionaler Klassenfilter: irgendein Item des Matches (irgendeine Runde) matcht regex.
+    # Regex läuft vektorisiert in DuckDB; übrig bleibt nur die Menge der Match-IDs.
+    class_filter = ""
     if class_regex:
-        pattern = re.compile(class_regex, re.IGNORECASE)
-        # Alle Items je Match (irgendeine Runde)
-        any_items = con.execute("""
-            SELECT DISTINCT match_id, item_name
+        con.execute("""
+            CREATE OR REPLACE TEMP TABLE class_matches AS
+            WITH class_items AS (
+              -- Regex nur einmal pro distinct Itemname statt pro round_items-Zeile
+              SELECT item_name
+              FROM (SELECT DISTINCT item_name FROM battles.round_items)
+              WHERE regexp_matches(item_name, ?, 'i')
+            )
+            SELECT DISTINCT match_id
             FROM battles.round_items
-        """).df()
-        reaper_matches = set(
-            any_items[any_items["item_name"].apply(lambda s: bool(pattern.search(str(s))))]["match_id"].unique()
-        )
+            WHERE item_name IN (SELECT item_name FROM class_items)
+        """, [class_regex])
+        n_class_matches = con.execute("SELECT COUNT(*) FROM class_matches").fetchone()[0]
 
-        if len(reaper_matches) == 0:
+        if n_class_matches == 0:
             print(f"[WARN] CLASS_REGEX '{class_regex}' hat 0 Matches. Fahre OHNE Klassenfilter fort.")
         else:
-            last_round_df = last_round_df[last_round_df["match_id"].isin(reaper_matches)]
-            items_df = items_df[items_df["match_id"].isin(reaper_matches)]
-
-    merged = items_df.merge(last_round_df, on="match_id", how="inner")
-    return merged  # columns: match_id, item_name, result, last_r
-
-def build_matrix(df, min_item_freq=20, max_items=250):
-    # Häufigkeitsfilter
-    freq = df["item_name"].value_counts()
-    keep_items = set(freq[freq >= min_item_freq].index[:max_items])
-    df = df[df["item_name"].isin(keep_items)].copy()
-
-    # Pivot → binäre Matrix
-    df["val"] = 1
-    mat = df.pivot_table(index="match_id", columns="item_name", values="val", aggfunc="max", fill_value=0)
-
-    # Labels
-    result = df.groupby("match_id")["result"].agg(lambda s: s.iloc[0])
-    last_r = df.groupby("match_id")["last_r"].max()
-
-    # Ordnung angleichen
-    mat = mat.sort_index()
-    result = result.reindex(mat.index)
-    last_r = last_r.reindex(mat.index)
-    return mat, result, last_r, freq
-
-def cluster_item_stats(mat_df, labels):
-    """Berechne pro Cluster Item-Raten, Lift usw."""
-    overall_rate = mat_df.mean(axis=0)
-    overall_count = mat_df.sum(axis=0)
-
-    rows = []
-    for c in sorted(labels.unique()):
-        cluster_rows = mat_df[labels == c]
-        if cluster_rows.empty:
-            continue
-
-        cluster_rate = cluster_rows.mean(axis=0)
-        cluster_count = cluster_rows.sum(axis=0)
-        # Lift = Anteil im Cluster im Verhältnis zur Gesamt-Verbreitung.
-        with np.errstate(divide="ignore", invalid="ignore"):
-            lift = cluster_rate / overall_rate.replace(0, np.nan)
-            lift = lift.replace([np.inf, -np.inf], np.nan).fillna(0.0)
-
-        rate_advantage = cluster_rate - overall_rate
-
-        tmp = pd.DataFrame({
-            "cluster": c,
-            "item": mat_df.columns,
-            "cluster_rate": cluster_rate.values,
-            "cluster_count": cluster_count.values,
-            "overall_rate": overall_rate.values,
-            "overall_count": overall_count.values,
-            "lift": lift.values,
-            "rate_advantage": rate_advantage.values,
-        })
-        rows.append(tmp)
-
-    if not rows:
-        return pd.DataFrame(columns=["cluster", "item", "cluster_rate", "cluster_count", "overall_rate", "overall_count", "lift", "rate_advantage"])
-
-    return pd.concat(rows, ignore_index=True)
-
-
-def select_core_items(stats_df):
-    """Filtere cluster-typische Items mithilfe eines Lift-Heuristik."""
+            class_filter = "AND f.match_id IN (SELECT match_id FROM class_matches)"
+
+    # Finale Runde je Match (gemeinsame finals-Tabelle) + deren Items in einem Statement,
+    # ggf. klassengefiltert. Long-Form bleibt in DuckDB.
+    ensure_finals(con)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE final_items AS
+        SELECT f.match_id, ri.item_name, f.result, f.last_r
+        FROM finals f
+        JOIN battles.round_items ri
+          ON ri.match_id = f.match_id AND ri.round_index = f.last_r
+        WHERE TRUE {class_filter}
+    """)
+    return con.execute("SELECT COUNT(*) FROM final_items").fetchone()[0]
+
+def build_matrix(con, min_item_freq=20, max_items=250):
+    # Häufigkeitsfilter als Allowlist direkt in DuckDB (GROUP BY/HAVING + TopN), Semi-Join beim Matrixaufbau
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE keep_items AS
+        SELECT item_name
+        FROM final_items
+        GROUP BY item_name
+        HAVING COUNT(*) >= ?
+        ORDER BY COUNT(*) DESC, item_name
+        LIMIT ?
+    """, [min_item_freq, max_items])
+    if con.execute("SELECT COUNT(*) FROM keep_items").fetchone()[0] == 0:
+        matches = pd.Index([], name="match_id")
+        items = pd.Index([], name="item_name")
+        mat = sp.csr_matrix((0, 0), dtype=np.float32)
+        return mat, matches, items, pd.Series(index=matches, dtype=bool), pd.Series(index=matches, dtype=float)
+
+    # Zeilen-/Spalten-Codes in DuckDB vergeben; pandas sieht die Long-Form nie.
+    # Kein PIVOT: Spaltennamen kämen dort umbenannt zurück ("flame" neben "Flame" -> "flame_1").
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE matrix_cols AS
+        SELECT item_name, CAST(row_number() OVER (ORDER BY item_name) - 1 AS INTEGER) AS col_id
+        FROM keep_items
+    """)
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE matrix_rows AS
+        SELECT match_id, result, last_r, CAST(row_number() OVER (ORDER BY match_id) - 1 AS INTEGER) AS row_id
+        FROM (
+          SELECT DISTINCT match_id, result, last_r
+          FROM final_items
+          WHERE item_name IN (SELECT item_name FROM keep_items)
+        )
+    """)
+    tbl = con.execute("SELECT match_id, result, last_r FROM matrix_rows ORDER BY row_id").fetch_arrow_table()
+    items = pd.Index(con.execute("SELECT item_name FROM matrix_cols ORDER BY col_id").fetch_arrow_table()
+                     .column("item_name").to_pylist(), name="item_name")
+    # DISTINCT: jede (Match, Item)-Zelle genau einmal, also keine Duplikate zu summieren
+    codes = con.execute("""
+        SELECT DISTINCT r.row_id, c.col_id
+        FROM final_items fi
+        JOIN matrix_rows r USING (match_id)
+        JOIN matrix_cols c USING (item_name)
+    """).fetch_arrow_table()
+
+    # Codes → Sparse (matches × items)
+    matches = pd.Index(tbl.column("match_id").to_numpy(), name="match_id")
+    row_idx = codes.column("row_id").to_numpy()
+    col_idx = codes.column("col_id").to_numpy()
+    mat = sp.csr_matrix(
+        (np.ones(len(row_idx), dtype=np.float32), (row_idx, col_idx)),
+        shape=(len(matches), len(items)),
+    )
+
+    # Labels (in Zeilenordnung der Matrix); Win-Flag direkt in Arrow statt Strings als Python-Objekte
+    win = pd.Series(pc.fill_null(pc.equal(tbl.column("result"), "win"), False).to_numpy(zero_copy_only=False), index=matches, name="win")
+    last_r = pd.Series(tbl.column("last_r").to_numpy(), index=matches, name="last_r")
+    return mat, matches, items, win, last_r
+
+def cluster_item_stats(mat, items, labels):
+    """Berechne pro Cluster Item-Raten, Lift usw. (mat: CSR matches × items)."""
+    columns = ["cluster", "item", "cluster_rate", "cluster_count", "overall_rate", "overall_count", "lift", "rate_advantage"]
+    if len(labels) == 0:
+        return pd.DataFrame(columns=columns)
+
+    overall_count = np.asarray(mat.sum(axis=0)).ravel().astype(np.int64)
+    overall_rate = overall_count / mat.shape[0]
+
+    # Ein Sparse-Produkt One-Hot(labels)ᵀ @ mat liefert alle Cluster-Summen auf einmal (K × items).
+    lab = labels.to_numpy()
+    n_clusters = int(lab.max()) + 1
+    onehot = sp.csr_matrix((np.ones(len(lab), dtype=np.float32), (np.arange(len(lab)), lab)), shape=(len(lab), n_clusters))
+    counts = np.asarray((onehot.T @ mat).todense()).astype(np.int64)
+    sizes = np.bincount(lab, minlength=n_clusters)
+
+    # Nur nicht-leere Cluster ausgeben
+    present = np.flatnonzero(sizes)
+    cluster_count = counts[present]
+    cluster_rate = cluster_count / sizes[present][:, None]
+    # Lift = Anteil im Cluster im Verhältnis zur Gesamt-Verbreitung (0, wenn Item global fehlt).
+    lift = np.divide(cluster_rate, overall_rate, out=np.zeros_like(cluster_rate), where=overall_rate > 0)
+    rate_advantage = cluster_rate - overall_rate
+
+    n_items = len(items)
+    return pd.DataFrame({
+        "cluster": np.repeat(present, n_items),
+        "item": np.tile(np.asarray(items), len(present)),
+        "cluster_rate": cluster_rate.ravel(),
+        "cluster_count": cluster_count.ravel(),
+        "overall_rate": np.tile(overall_rate, len(present)),
+        "overall_count": np.tile(overall_count, len(present)),
+        "lift": lift.ravel(),
+        "rate_advantage": rate_advantage.ravel(),
+    }, columns=columns)
+
+
+def select_core_items(con, stats_df):
+    """Filtere cluster-typische Items mithilfe eines Lift-Heuristik (Ranking per Fensterfunktion in DuckDB)."""
+    staple_filter = "" if STAPLE_MAX_GLOBAL_RATE is None else f"AND overall_rate <= {float(STAPLE_MAX_GLOBAL_RATE)}"
+    # pos = Zeilenreihenfolge in stats_df; bricht Gleichstände wie ein stabiler Sort
+    con.register("cluster_stats", stats_df.reset_index(drop=True).rename_axis("pos").reset_index())
+    rows = con.execute(f"""
+        WITH flagged AS (
+          SELECT cluster, item, pos, cluster_rate, cluster_count, lift,
+                 (cluster_rate >= $min_rate AND cluster_count >= $min_count AND lift >= $min_lift {staple_filter}) AS eligible
+          FROM cluster_stats
+        ),
+        ranked AS (
+          SELECT *,
+                 row_number() OVER (PARTITION BY cluster ORDER BY cluster_rate DESC, cluster_count DESC, pos) AS freq_rank,
+                 row_number() OVER (PARTITION BY cluster, eligible ORDER BY lift DESC, cluster_rate DESC, cluster_count DESC, pos) AS lift_rank
+          FROM flagged
+        )
+        SELECT
+          cluster,
+          list(item ORDER BY freq_rank) FILTER (WHERE freq_rank <= $top_k)              AS top_items_freq,
+          list(item ORDER BY lift_rank) FILTER (WHERE eligible AND lift_rank <= $top_k) AS core_items_lift
+        FROM ranked
+        GROUP BY cluster
+        ORDER BY cluster
+    """, {
+        "min_rate": CORE_MIN_CLUSTER_RATE,
+        "min_count": CORE_MIN_COUNT,
+        "min_lift": CORE_MIN_LIFT,
+        "top_k": CORE_TOP_K,
+    }).fetchall()
+    con.unregister("cluster_stats")
+
     result_lift = {}
     result_freq = {}
-
-    for cluster_id, group in stats_df.groupby("cluster"):
-        group_sorted_freq = group.sort_values(["cluster_rate", "cluster_count"], ascending=False)
-        result_freq[cluster_id] = group_sorted_freq.head(CORE_TOP_K)["item"].tolist()
-
-        eligible = group[
-            (group["cluster_rate"] >= CORE_MIN_CLUSTER_RATE)
-            & (group["cluster_count"] >= CORE_MIN_COUNT)
-            & (group["lift"] >= CORE_MIN_LIFT)
-        ]
-
-        if STAPLE_MAX_GLOBAL_RATE is not None:
-            eligible = eligible[eligible["overall_rate"] <= STAPLE_MAX_GLOBAL_RATE]
-
-        if eligible.empty:
-            shortlisted = group_sorted_freq.head(CORE_TOP_K)
-        else:
-            shortlisted = eligible.sort_values(["lift", "cluster_rate", "cluster_count"], ascending=False).head(CORE_TOP_K)
-
-        result_lift[cluster_id] = shortlisted["item"].tolist()
+    for cluster_id, top_freq, core_lift in rows:
+        result_freq[cluster_id] = top_freq or []
+        # Keine Items erfüllen die Heuristik → Fallback auf die häufigsten Items
+        result_lift[cluster_id] = core_lift or result_freq[cluster_id]
 
     return result_lift, result_freq
 
 # ---- Main logic ----
-df = fetch_final_items(con, CLASS_REGEX)
-if df.empty:
+n_final_items = fetch_final_items(con, CLASS_REGEX)
+if n_final_items == 0:
     # Mini-Diagnose: häufigste Itemnamen zeigen, damit man sieht, worauf man filtern KÖNNTE
     sample_items = con.execute("""
         SELECT item_name, COUNT(*) AS cnt
@@ -183,38 +237,60 @@ if df.empty:
     print(sample_items)
     raise SystemExit("No data available for clustering after filter. Disable CLASS_REGEX or adjust.")
 
-mat, result, last_r, freq = build_matrix(df, min_item_freq=MIN_ITEM_FREQ, max_items=MAX_ITEMS)
+mat, matches, items, win, last_r = build_matrix(con, min_item_freq=MIN_ITEM_FREQ, max_items=MAX_ITEMS)
 
-if mat.empty:
+if mat.shape[0] == 0 or mat.shape[1] == 0:
     print("[ERROR] Nach MIN_ITEM_FREQ/MAX_ITEMS-Filter ist die Matrix leer.")
-    print("Top-Items in der (ungefilterten) DF:")
-    print(freq.head(25))
+    print("Top-Items in der (ungefilterten) finalen Runde:")
+    # Diagnose-Häufigkeiten nur im Fehlerfall abfragen
+    print(con.execute("""
+        SELECT item_name, COUNT(*) AS cnt
+        FROM final_items
+        GROUP BY item_name
+        ORDER BY cnt DESC, item_name
+        LIMIT 25
+    """).df().set_index("item_name")["cnt"])
     raise SystemExit("Empty matrix after frequency filtering. Loosen MIN_ITEM_FREQ/MAX_ITEMS.")
 
-km = KMeans(n_clusters=K, n_init=20, random_state=42)
-labels = pd.Series(km.fit_predict(mat.values), index=mat.index, name="cluster")
-
-# Cluster-Metriken
-out_rows = []
-for c in range(K):
-    idx = labels[labels == c].index
-    size = len(idx)
-    wr = (result.loc[idx].eq("win").mean() * 100.0) if size > 0 else float('nan')
-    med_len = float(last_r.loc[idx].median()) if size > 0 else float('nan')
-    out_rows.append({"cluster": c, "n_matches": size, "winrate_pct": wr, "median_final_round": med_len})
-
-summary = pd.DataFrame(out_rows).sort_values(["winrate_pct", "n_matches"], ascending=[False, False])
+# Mini-Batch statt 20 voller Lloyd-Restarts; auf binären Sparse-Daten praktisch gleiche Cluster.
+km = MiniBatchKMeans(
+    n_clusters=K,
+    n_init=KMEANS_N_INIT,
+    batch_size=KMEANS_BATCH_SIZE,
+    max_iter=KMEANS_MAX_ITER,
+    random_state=42,
+    reassignment_ratio=0.01,
+)
+# 0/1-Daten: float32 reicht und halbiert die Bandbreite ggü. float64 (no-op, wenn schon float32)
+X = mat.astype(np.float32, copy=False)
+if TFIDF_WEIGHTING:
+    # nur die Clustering-Eingabe wird gewichtet; Cluster-Statistiken laufen weiter auf der Binärmatrix
+    X = TfidfTransformer().fit_transform(X).astype(np.float32, copy=False)
+labels = pd.Series(km.fit_predict(X), index=matches, name="cluster")
+
+# Cluster-Metriken: ein groupby statt K Masken-Scans; leere Cluster bleiben per reindex erhalten
+summary = (
+    pd.DataFrame({"win": win, "last_r": last_r, "cluster": labels})
+    .groupby("cluster")
+    .agg(n_matches=("win", "size"), winrate_pct=("win", "mean"), median_final_round=("last_r", "median"))
+    .reindex(range(K))
+    .rename_axis("cluster")
+    .reset_index()
+)
+summary["n_matches"] = summary["n_matches"].fillna(0).astype(int)
+summary["winrate_pct"] = summary["winrate_pct"] * 100.0
+summary = summary.sort_values(["winrate_pct", "n_matches"], ascending=[False, False])
 
 # Cluster-Item-Statistiken & Kern-Items
-mat_df = pd.DataFrame(mat.values, index=mat.index, columns=mat.columns)
-stats_df = cluster_item_stats(mat_df, labels)
-core_by_lift, core_by_freq = select_core_items(stats_df)
+stats_df = cluster_item_stats(mat, items, labels)
+core_by_lift, core_by_freq = select_core_items(con, stats_df)
 top_items_rows = []
 for c in sorted(labels.unique()):
+    # Listen als JSON serialisieren, damit 05 sie per json.loads statt ast.literal_eval liest
     top_items_rows.append({
         "cluster": c,
-        "core_items_lift": core_by_lift.get(c, []),
-        "top_items_freq": core_by_freq.get(c, []),
+        "core_items_lift": json.dumps(core_by_lift.get(c, []), ensure_ascii=False),
+        "top_items_freq": json.dumps(core_by_freq.get(c, []), ensure_ascii=False),
     })
 
 # Outputs
@@ -223,10 +299,11 @@ items_path   = os.path.join(OUT_DIR, "reaper_clusters_core_items.csv")
 assign_path  = os.path.join(OUT_DIR, "reaper_clusters_assignment.csv")
 stats_path   = os.path.join(OUT_DIR, "reaper_clusters_item_stats.csv")
 
-summary.to_csv(summary_path, index=False)
-pd.DataFrame(top_items_rows).to_csv(items_path, index=False)
-pd.DataFrame({"match_id": labels.index, "cluster": labels.values}).to_csv(assign_path, index=False)
-stats_df.to_csv(stats_path, index=False)
+# CSV-Writer von pyarrow (C++) statt pandas.to_csv
+pacsv.write_csv(pa.Table.from_pandas(summary, preserve_index=False), summary_path)
+pacsv.write_csv(pa.Table.from_pandas(pd.DataFrame(top_items_rows), preserve_index=False), items_path)
+pacsv.write_csv(pa.table({"match_id": labels.index.to_numpy(), "cluster": labels.to_numpy()}), assign_path)
+pacsv.write_csv(pa.Table.from_pandas(stats_df, preserve_index=False), stats_path)
 
 print("wrote:", summary_path)
 print("wrote:", items_path)
@@ -1,5 +1,5 @@
 # winrate_facets_delta.py
-import pandas as pd
+import duckdb
 import matplotlib.pyplot as plt
 from matplotlib.ticker import PercentFormatter
 from sklearn.cluster import KMeans
@@ -12,13 +12,16 @@ OUT_DIR.mkdir(exist_ok=True)
 
 
 # ---------- Load & filter ----------
-df = pd.read_csv(CSV)
-# sinnvolle Stichprobe und Rundenbereich
-df = df[(df["n_reached"] >= 50) & (df["round"].between(1, 18))].copy()
-
-# Wir nehmen DELTA (mit minus ohne), das steht schon als Spalte drin
+# Filter direkt beim CSV-Scan in DuckDB; nach pandas kommen nur die benötigten Spalten/Zeilen.
+# sinnvolle Stichprobe und Rundenbereich; Delta (mit minus ohne) steht schon als Spalte drin.
 # Delta ist in [−1, +1], wir plotten als %
-df = df[np.isfinite(df["delta_winrate"])]
+df = duckdb.execute("""
+    SELECT round, item_name, delta_winrate
+    FROM read_csv_auto(?)
+    WHERE n_reached >= 50
+      AND round BETWEEN 1 AND 18
+      AND isfinite(delta_winrate)
+""", [CSV]).df()
 
 # ---------- Wide pivot: round × item → delta ----------
 pivot = df.pivot_table(index="round",
@@ -39,50 +42,53 @@ n_items = pivot.shape[1]
 # Grobe Heuristik: ~10 Items pro Cluster, 2–10 Cluster
 n_clusters = int(np.clip(round(n_items / 10), 2, 10))
 km = KMeans(n_clusters=n_clusters, n_init=20, random_state=42)
-labels = km.fit_predict(pivot.T.values)
-
-curve_df = pivot.T.copy()
-curve_df["cluster"] = labels
+# Kurven als reines (items × rounds)-Array, Cluster-Labels als separater Vektor
+curves = pivot.T.to_numpy()
+item_names = pivot.columns.to_numpy()
+labels = km.fit_predict(curves)
 
 even_rounds = [r for r in pivot.index if r % 2 == 0]  # nur gerade Runden auf der Achse
 
 # ---------- Facets: 10 Items pro Cluster ----------
-for c in sorted(curve_df["cluster"].unique()):
-    subset = curve_df[curve_df["cluster"] == c].drop(columns=["cluster"])
-    if subset.empty:
+# Eine Figure/Achse für alle Cluster wiederverwenden statt pro Cluster neu anzulegen
+fig, ax = plt.subplots(figsize=(9, 5.5))
+for c in np.unique(labels):
+    mask = labels == c
+    subset, subset_names = curves[mask], item_names[mask]
+    if len(subset) == 0:
         continue
     # Repräsentative Auswahl: hohe Varianz bevorzugen, sonst random fallback
-    variances = subset.var(axis=1).sort_values(ascending=False)
-    pick = variances.index[:min(10, len(variances))]
-    sample = subset.loc[pick]
+    order = np.argsort(-subset.var(axis=1, ddof=1), kind="stable")[:10]
+    sample, sample_names = subset[order], subset_names[order]
 
     # Y-Limits mit etwas Puffer
-    y_min = float(sample.min().min())
-    y_max = float(sample.max().max())
+    y_min = float(sample.min())
+    y_max = float(sample.max())
     pad = max(0.02, (y_max - y_min) * 0.15)
     lo, hi = y_min - pad, y_max + pad
     # clamp, damit es nicht völlig ausrastet
     lo = max(-1.0, lo)
     hi = min( 1.0, hi)
 
-    plt.figure(figsize=(9, 5.5))
-    for item_name, row in sample.iterrows():
-        plt.plot(pivot.index,
-                 row.values,
-                 marker="o", markersize=3, linewidth=1,
-                 label=item_name, alpha=0.9)
+    ax.clear()
+    for item_name, row in zip(sample_names, sample):
+        ax.plot(pivot.index,
+                row,
+                marker="o", markersize=3, linewidth=1,
+                label=item_name, alpha=0.9)
 
-    plt.title(f"Cluster {c} — Δ-Winrate vs. ohne Item (10 Items)")
-    plt.xlabel("Round")
-    plt.ylabel("Δ-Winrate")
-    plt.gca().yaxis.set_major_formatter(PercentFormatter(xmax=1.0))
-    plt.ylim(lo, hi)
-    plt.xticks(even_rounds)
-    plt.grid(True, axis="y", alpha=0.25)
+    ax.set_title(f"Cluster {c} — Δ-Winrate vs. ohne Item (10 Items)")
+    ax.set_xlabel("Round")
+    ax.set_ylabel("Δ-Winrate")
+    ax.yaxis.set_major_formatter(PercentFormatter(xmax=1.0))
+    ax.set_ylim(lo, hi)
+    ax.set_xticks(even_rounds)
+    ax.grid(True, axis="y", alpha=0.25)
     # Legende schlank, sonst Rand überfüllt
-    plt.legend(fontsize=7, loc="best", frameon=False)
-    plt.tight_layout()
-    plt.savefig(OUT_DIR / f"delta_winrate_cluster_{c}.png", dpi=150)
-    plt.close()
+    ax.legend(fontsize=7, loc="best", frameon=False)
+    fig.tight_layout()
+    fig.savefig(OUT_DIR / f"delta_winrate_cluster_{c}.png", dpi=150)
+
+plt.close(fig)
 
 print(f"Fertig. PNGs liegen in: {OUT_DIR.resolve()}")
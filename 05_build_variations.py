@@ -10,10 +10,12 @@ Output: ``bpb_out/reaper_build_variations.csv``
 from __future__ import annotations
 
 import ast
+import json
 import os
 from dataclasses import dataclass
 from typing import Dict, List, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 
 # ============== CONFIG =================
@@ -34,15 +36,26 @@ CORE_PREFIX_SIZE = 4          # display first N core items for context
 
 def _load_core_items(path: str) -> Dict[int, List[str]]:
     df = pd.read_csv(path)
-    core_lookup: Dict[int, List[str]] = {}
-    for _, row in df.iterrows():
-        cluster = int(row["cluster"])
+    # core item lists are written as JSON by 03_reaper_clustering.py (older files: Python literals)
+    core_items = df["core_items_lift"].map(_parse_item_list)
+    return dict(zip(df["cluster"].astype(int), core_items))
+
+
+def _parse_item_list(raw: object) -> List[str]:
+    text = str(raw)
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        # files written before the JSON switch hold Python list literals ("['a', 'b']")
         try:
-            core_items = ast.literal_eval(str(row["core_items_lift"]))
+            items = ast.literal_eval(text)
         except (SyntaxError, ValueError):
-            core_items = []
-        core_lookup[cluster] = [str(item) for item in core_items]
-    return core_lookup
+            print(f"[WARN] could not parse core item list {text!r}; treating it as empty")
+            return []
+    if not isinstance(items, list):
+        print(f"[WARN] core item cell is not a list: {text!r}; treating it as empty")
+        return []
+    return [str(item) for item in items]
 
 
 def _load_cluster_stats(path: str) -> pd.DataFrame:
@@ -51,13 +64,15 @@ def _load_cluster_stats(path: str) -> pd.DataFrame:
     return df
 
 
-def _load_pairs(path: str) -> pd.DataFrame:
+def _load_pairs(path: str, min_lift: float = MIN_LIFT, min_pmi: float = MIN_PMI) -> pd.DataFrame:
     df = pd.read_csv(path)
     # ensure numeric columns are floats for scoring
     for col in ("lift", "pmi", "pAB", "pA", "pB"):
         if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors="coerce")
-    return df.dropna(subset=["lift", "pmi"])
+    df = df.dropna(subset=["lift", "pmi"])
+    # weak correlations can never become a variation; drop them before the lookup is built
+    return df[(df["lift"] >= min_lift) & (df["pmi"] >= min_pmi)].reset_index(drop=True)
 
 
 @dataclass
@@ -103,11 +118,10 @@ def build_variations(
         for cluster, cluster_df in stats_df.groupby("cluster")
     }
 
-    # quick lookup for item -> list of candidate pairs
-    pair_lookup: Dict[str, List[pd.Series]] = {}
-    for _, row in pairs_df.iterrows():
-        pair_lookup.setdefault(row["A"], []).append(row)
-        pair_lookup.setdefault(row["B"], []).append(row)
+    pairs = pairs_df.assign(A=pairs_df["A"].astype(str), B=pairs_df["B"].astype(str))
+    if "nAB" not in pairs.columns:
+        pairs["nAB"] = 0
+    pairs = pairs[["A", "B", "lift", "pmi", "nAB"]].drop_duplicates(["A", "B"])
 
     for cluster, core_items in core_lookup.items():
         stats = grouped_stats.get(cluster)
@@ -118,64 +132,59 @@ def build_variations(
         candidate_mask = (stats["cluster_rate"] >= MIN_CLUSTER_RATE) & (
             stats["rate_advantage"] >= MIN_RATE_ADV
         )
-        candidates = set(stats[candidate_mask].index.astype(str))
-        if not candidates:
+        cand = stats.loc[candidate_mask, "cluster_rate"]
+        if cand.empty:
+            continue
+        cand = pd.DataFrame({"item": cand.index.astype(str), "rate": cand.to_numpy(dtype=float)})
+
+        # keep only pairs whose items are both candidates, with their cluster rates attached
+        scored = pairs.merge(cand.rename(columns={"item": "A", "rate": "cluster_rate_a"}), on="A").merge(
+            cand.rename(columns={"item": "B", "rate": "cluster_rate_b"}), on="B"
+        )
+        if scored.empty:
             continue
+        scored["score"] = scored["lift"] * scored["pmi"] * (scored["cluster_rate_a"] + scored["cluster_rate_b"]) / 2.0
+        # rank variations per cluster by score; partial top-k selection instead of sorting every pair
+        top = scored.nlargest(MAX_VARIATIONS_PER_CLUSTER, "score", keep="first")
 
+        # classify all surviving pairs at once instead of per-pair set lookups
         core_set = {str(item) for item in core_items}
+        a_core = top["A"].isin(core_set).to_numpy()
+        b_core = top["B"].isin(core_set).to_numpy()
+        # anchor follows variation_type; for core+flex it is whichever side is core
+        top = top.assign(
+            variation_type=np.where(a_core & b_core, "core-pair", np.where(a_core | b_core, "core+flex", "flex-pair")),
+            core_item=np.where(a_core, top["A"], top["B"]),
+        )
 
         cluster_variations: List[Variation] = []
-        seen_pairs = set()
-
-        for item in candidates:
-            for pair in pair_lookup.get(item, []):
-                a = str(pair["A"])
-                b = str(pair["B"])
-                if {a, b}.issubset(candidates):
-                    # guard to avoid duplicates
-                    key = tuple(sorted((cluster, a, b)))
-                    if key in seen_pairs:
-                        continue
-                    seen_pairs.add(key)
-
-                    lift = float(pair["lift"])
-                    pmi = float(pair["pmi"])
-                    if lift < MIN_LIFT or pmi < MIN_PMI:
-                        continue
-
-                    rate_a = float(stats.at[a, "cluster_rate"])
-                    rate_b = float(stats.at[b, "cluster_rate"])
-                    # Variation type logic
-                    if a in core_set and b in core_set:
-                        variation_type = "core-pair"
-                        anchor = tuple(sorted({a, b}))
-                    elif a in core_set or b in core_set:
-                        variation_type = "core+flex"
-                        anchor = tuple(sorted({a} if a in core_set else {b}))
-                    else:
-                        variation_type = "flex-pair"
-                        anchor = tuple()
-
-                    score = (lift * pmi) * ((rate_a + rate_b) / 2.0)
-                    variation_items = tuple(sorted({a, b}))
-                    cluster_variations.append(
-                        Variation(
-                            cluster=cluster,
-                            variation_type=variation_type,
-                            anchor=anchor,
-                            items=variation_items,
-                            lift=lift,
-                            pmi=pmi,
-                            nAB=int(pair.get("nAB", 0)),
-                            cluster_rate_a=rate_a,
-                            cluster_rate_b=rate_b,
-                            score=score,
-                        )
-                    )
-
-        # rank variations per cluster by score
-        cluster_variations.sort(key=lambda v: v.score, reverse=True)
-        variations_by_cluster[cluster] = cluster_variations[:MAX_VARIATIONS_PER_CLUSTER]
+        for a, b, lift, pmi, nab, rate_a, rate_b, score, variation_type, core_item in top[
+            ["A", "B", "lift", "pmi", "nAB", "cluster_rate_a", "cluster_rate_b", "score", "variation_type", "core_item"]
+        ].itertuples(index=False):
+            items = tuple(sorted({a, b}))
+            if variation_type == "core-pair":
+                anchor = items
+            elif variation_type == "core+flex":
+                anchor = (core_item,)
+            else:
+                anchor = tuple()
+
+            cluster_variations.append(
+                Variation(
+                    cluster=cluster,
+                    variation_type=variation_type,
+                    anchor=anchor,
+                    items=items,
+                    lift=float(lift),
+                    pmi=float(pmi),
+                    nAB=int(nab) if pd.notna(nab) else 0,
+                    cluster_rate_a=float(rate_a),
+                    cluster_rate_b=float(rate_b),
+                    score=float(score),
+                )
+            )
+
+        variations_by_cluster[cluster] = cluster_variations
 
     all_variations: List[Variation] = []
     for cluster in sorted(variations_by_cluster):
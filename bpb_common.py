@@ -0,0 +1,84 @@
+"""
+Gemeinsame DuckDB-Hilfen für die Analyse-Skripte (00–03).
+Materialisiert Zwischenergebnisse, die mehrere Skripte brauchen, einmal pro Session.
+"""
+import os
+
+import duckdb
+
+PREWARM_TABLES = ("battles.rounds", "battles.round_items")
+# Opt-in: BPB_PREWARM=1 lädt die Basistabellen vorab in den Buffer-Pool.
+# Setzt eine bereits installierte Extension voraus (einmalig: INSTALL cache_prewarm FROM community;).
+PREWARM = os.environ.get("BPB_PREWARM", "0") not in ("", "0")
+
+
+def prewarm(con, tables=PREWARM_TABLES):
+    """
+    Lädt die großen Basistabellen vorab in den Buffer-Pool (Extension cache_prewarm),
+    damit die erste Query nicht den kompletten Kaltstart-Read bezahlt.
+    Nur mit BPB_PREWARM=1; installiert nichts, sondern LOADet nur eine vorhandene Extension.
+    """
+    if not PREWARM:
+        return
+    try:
+        con.execute("LOAD cache_prewarm;")
+        con.execute("SELECT " + ", ".join(f"prewarm('{t}')" for t in tables) + ";")
+    except duckdb.Error as e:
+        print(f"[WARN] Prewarm übersprungen (cache_prewarm nicht installiert?): {str(e).splitlines()[0]}")
+
+
+def ensure_denom(con, name="denom", temp=True):
+    """
+    Legt denom(round, n_reached) an, falls noch nicht vorhanden:
+    Anzahl Matches, die Runde r erreicht haben.
+    temp=False für Tabellen in einer angehängten DB (z.B. 'scratch.denom'),
+    die auch von weiteren Cursorn gesehen werden müssen.
+    """
+    kind = "TEMP TABLE" if temp else "TABLE"
+    # rounds ist per PK eindeutig je (match_id, round_index) -> COUNT(*) reicht
+    con.execute(f"""
+        CREATE {kind} IF NOT EXISTS {name} AS
+        SELECT round_index AS round, COUNT(*) AS n_reached
+        FROM battles.rounds
+        GROUP BY round_index;
+    """)
+
+
+def ensure_finals(con, name="finals", temp=True):
+    """
+    Legt finals(match_id, result, last_r) an, falls noch nicht vorhanden:
+    eine Zeile pro Match mit letzter Runde und deren Ergebnis.
+    Ersetzt das "last_round-CTE + Join auf rounds"-Muster in den einzelnen Skripten.
+    """
+    kind = "TEMP TABLE" if temp else "TABLE"
+    con.execute(f"""
+        CREATE {kind} IF NOT EXISTS {name} AS
+        WITH lr AS (
+          SELECT match_id, MAX(round_index) AS last_r
+          FROM battles.rounds
+          GROUP BY match_id
+        )
+        SELECT r.match_id, r.result, lr.last_r
+        FROM battles.rounds r
+        JOIN lr USING (match_id)
+        WHERE r.round_index = lr.last_r;
+    """)
+
+
+def ensure_item_dict(con, name="item_dict", ri_name="ri_int"):
+    """
+    Legt item_dict(item_id, item_name) und ri_int(match_id, round_index, item_id) an,
+    falls noch nicht vorhanden: Item-Namen -> SMALLINT-IDs in Namensreihenfolge
+    (damit "A < B" dieselben Paare liefert wie der String-Vergleich) und round_items auf IDs.
+    """
+    con.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {name} AS
+        SELECT CAST(row_number() OVER (ORDER BY item_name) - 1 AS SMALLINT) AS item_id, item_name
+        FROM (SELECT DISTINCT item_name FROM battles.round_items);
+    """)
+    con.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {ri_name} AS
+        SELECT ri.match_id, ri.round_index, d.item_id
+        FROM battles.round_items ri
+        JOIN {name} d USING (item_name);
+    """)
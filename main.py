@@ -42,25 +42,29 @@ CREATE TABLE IF NOT EXISTS battles.round_items (
 );
 """)
 
+# ---------- Raw JSON einmal einlesen ----------
+# Beide Ingests lesen aus derselben Staging-Tabelle statt die JSONs zweimal zu parsen
+sql_stage_raw = """
+CREATE OR REPLACE TEMP TABLE raw AS
+SELECT filename, matchIndex, rounds
+FROM read_json_auto(
+       ?, 
+       filename=true, 
+       union_by_name=1,       -- ← mischy JSONs harmonisieren
+       sample_size=-1         -- ← alles samplen für robustes Schema
+     );
+"""
+
 # ---------- Ingest Rounds ----------
 sql_ingest_rounds = """
-WITH src AS (
-  SELECT filename, matchIndex, rounds
-  FROM read_json_auto(
-         ?, 
-         filename=true, 
-         union_by_name=1,       -- ← mischy JSONs harmonisieren
-         sample_size=-1         -- ← alles samplen für robustes Schema
-       )
-),
-u AS (
+WITH u AS (
   SELECT
       s.filename                                   AS source_file,
       CAST(s.matchIndex AS BIGINT)                 AS match_id,
       CAST(r.unnest.roundIndex AS INTEGER)         AS round_index,
       LOWER(CAST(r.unnest.result AS VARCHAR))      AS result,
       CAST(r.unnest.gold AS INTEGER)               AS gold
-  FROM src s, UNNEST(s.rounds) AS r
+  FROM raw s, UNNEST(s.rounds) AS r
 ),
 rnk AS (
   SELECT u.*,
@@ -74,31 +78,18 @@ INSERT INTO battles.rounds (source_file, match_id, round_index, result, gold)
 SELECT source_file, match_id, round_index, result, gold
 FROM rnk
 WHERE rn = 1
-  AND NOT EXISTS (
-      SELECT 1 FROM battles.rounds t
-      WHERE t.match_id = rnk.match_id
-        AND t.round_index = rnk.round_index
-  );
+ON CONFLICT DO NOTHING;   -- bereits vorhandene (match_id, round_index) per PK-Index überspringen
 """
 
 # ---------- Ingest Items ----------
 sql_ingest_items = """
-WITH src AS (
-  SELECT filename, matchIndex, rounds
-  FROM read_json_auto(
-         ?, 
-         filename=true, 
-         union_by_name=1,
-         sample_size=-1
-       )
-),
-u AS (
+WITH u AS (
   SELECT
       s.filename                                   AS source_file,
       CAST(s.matchIndex AS BIGINT)                 AS match_id,
       CAST(r.unnest.roundIndex AS INTEGER)         AS round_index,
       r.unnest.items                               AS items
-  FROM src s, UNNEST(s.rounds) AS r
+  FROM raw s, UNNEST(s.rounds) AS r
 ),
 j AS (
   SELECT
@@ -123,17 +114,13 @@ INSERT INTO battles.round_items (source_file, match_id, round_index, item_name,
 SELECT source_file, match_id, round_index, item_name, item_count
 FROM rnk
 WHERE rn = 1
-  AND NOT EXISTS (
-      SELECT 1 FROM battles.round_items t
-      WHERE t.match_id   = rnk.match_id
-        AND t.round_index = rnk.round_index
-        AND t.item_name   = rnk.item_name
-  );
+ON CONFLICT DO NOTHING;   -- bereits vorhandene Keys per PK-Index überspringen
 """
 
 # Execute ingestion
-con.execute(sql_ingest_rounds, [RAW_GLOB])
-con.execute(sql_ingest_items, [RAW_GLOB])
+con.execute(sql_stage_raw, [RAW_GLOB])
+con.execute(sql_ingest_rounds)
+con.execute(sql_ingest_items)
 
 # Simple counts
 rounds_cnt = con.execute("SELECT COUNT(*) FROM battles.rounds;").fetchone()[0]